@@ -13,6 +13,7 @@ class BaseKNN(RecommenderBase):
         self.entity_vectors = np.zeros((n_xs, n_ys))
         self.plain_entity_vectors = np.zeros((n_xs, n_ys))
         self.pearson_entity_vectors = np.zeros((n_xs, n_ys))
+        self.metric_vectors = {}
         self.user_ratings = {}
         self.k = 1
 
@@ -22,6 +23,14 @@ class BaseKNN(RecommenderBase):
     def _set_self(self, configuration):
         raise NotImplementedError
 
+    def _set_metric(self, metric):
+        # The vectors are not modified after fit, so they are shared rather than copied for every configuration
+        self.entity_vectors = self.metric_vectors[metric]
+
+    def _top_k(self, similarities):
+        # Indices of the k most similar along the last axis, found by partitioning rather than sorting
+        return np.argpartition(-similarities, self.k - 1, axis=-1)[..., :self.k]
+
     def _fit_pred(self, cur_config, best_config, validation, verbose):
         cur_config = cur_config.copy()
         best_config = best_config.copy()
@@ -1,6 +1,5 @@
 import numpy as np 
 import pandas as pd
-from scipy.spatial.distance import cosine
 
 from models.base_recommender import RecommenderBase
 
@@ -13,7 +12,9 @@ class CbfItemKnnRecommender(RecommenderBase):
         self.n_entities = max(split.experiment.dataset.e_idx_map.values()) + 1
         self.n_users = split.n_users
 
-        self.entity_vectors = np.zeros((self.n_entities, self.n_entities))
+        # One-hot vectors are stored exactly as int8, with a per-entity scale holding the inverse L2 norm
+        self.entity_vectors = np.zeros((self.n_entities, self.n_entities), dtype=np.int8)
+        self.entity_scales = np.ones(self.n_entities, dtype=np.float32)
         self.user_ratings = np.zeros((self.n_users, self.n_entities))
 
         self.optimal_params = {'k': 100}
@@ -32,7 +33,7 @@ class CbfItemKnnRecommender(RecommenderBase):
         # Load the KG. Entity vectors should be a one-hot encoding
         # of related 1-hop neighbours
         e_idx_map = self.split.experiment.dataset.e_idx_map
-        for h, r, t in self._load_kg():
+        for h, t in self._load_kg():
             if h not in e_idx_map or t not in e_idx_map:
                 continue
             h = e_idx_map[h]
@@ -41,6 +42,11 @@ class CbfItemKnnRecommender(RecommenderBase):
             self.entity_vectors[h][t] = 1
             self.entity_vectors[t][h] = 1
 
+        # Inverse L2 norms, such that similarities reduce to scaled dot products. Entities without KG edges have
+        # a similarity of 0 to everything, where scipy's cosine distance previously produced NaN predictions.
+        norms = np.sqrt(np.einsum('ij,ij->i', self.entity_vectors, self.entity_vectors, dtype=np.int64))
+        self.entity_scales = (1.0 / np.maximum(norms, 1e-8)).astype(np.float32)
+
         # Save users' ratings
         for user, ratings in training:
             for rating in ratings:
@@ -64,22 +70,27 @@ class CbfItemKnnRecommender(RecommenderBase):
         k = self.optimal_params['k']
         items_rated_by_user, = (self.user_ratings[user]).nonzero()
 
-        predictions = []
+        # Similarities between all candidate items and all rated items in a single matrix product
+        similarities = self._similarities(items, items_rated_by_user)
 
-        for item in items:
-            sorted_neighbours = sorted([(other, 1 - cosine(self.entity_vectors[item], self.entity_vectors[other]))
-                                        for other in items_rated_by_user], reverse=True)
-            sorted_neighbours = list(sorted_neighbours)[:k]
+        # Neighbours are sorted by (neighbour, similarity) in descending order. nonzero() returns
+        # the rated items in ascending order, so the top-k neighbours are the last k columns.
+        neighbours = items_rated_by_user[::-1][:k]
+        neighbour_similarities = similarities[:, ::-1][:, :k]
+        predictions = neighbour_similarities.dot(self.user_ratings[user][neighbours])
 
-            predicted_rating = sum([similarity * self.user_ratings[user][neighbour]
-                                    for neighbour, similarity in sorted_neighbours])
+        return {item: prediction for item, prediction in zip(items, predictions)}
 
-            predictions.append((item, predicted_rating))
+    def _similarities(self, items, others):
+        # Only the gathered rows are widened to float32, which is exact for one-hot vectors
+        item_vecs = self.entity_vectors[items].astype(np.float32)
+        other_vecs = self.entity_vectors[others].astype(np.float32)
+        dots = item_vecs.dot(other_vecs.T)
 
-        return {item: prediction for item, prediction in predictions}
+        return dots * self.entity_scales[items][:, np.newaxis] * self.entity_scales[others]
 
     def _load_kg(self):
         with open('data/triples.csv') as fp: 
-            triples = pd.read_csv(fp)
-            triples = [(h, r, t) for h, r, t in triples[['head_uri', 'relation', 'tail_uri']].values]
-            return triples
\ No newline at end of file
+            # Only the endpoints are used, so skip parsing the relation column entirely
+            triples = pd.read_csv(fp, usecols=['head_uri', 'tail_uri'])
+            return [(h, t) for h, t in triples[['head_uri', 'tail_uri']].values]
\ No newline at end of file
@@ -13,6 +13,11 @@ class ItemKNNRecommender(BaseKNN):
         self.use_shrunk_similarity = True
         self.shrink_factor = 100
         self.shrunk_similarity = np.zeros((self.n_xs, self.n_xs))
+        self.metric = None
+        self.cache_similarities = False
+        self.similarity_cache = dict()
+        self.similarity_cache_bytes = 0
+        self.similarity_cache_limit = 256 * 2 ** 20
 
         self.optimal_params = None
 
@@ -67,7 +72,14 @@ class ItemKNNRecommender(BaseKNN):
 
             self.shrunk_similarity[i] = sim_i_j
 
+        self.metric_vectors = {
+            'cosine': self.plain_entity_vectors,
+            'adjusted_cosine': self.user_adjusted_entity_vectors,
+            'pearson': self.pearson_entity_vectors
+        }
+
         if self.optimal_params is None:
+            self.cache_similarities = True
             last_better = True
             best_outer_config = {'metric': 'cosine', 'k': 10, 'hit_rate': -1, 'use_shrunk': False, 'shrink_factor': 100}
             best_inner_config = {'metric': 'cosine', 'k': 10, 'hit_rate': 0, 'use_shrunk': False, 'shrink_factor': 100}
@@ -108,6 +120,9 @@ class ItemKNNRecommender(BaseKNN):
                 else:
                     last_better = False
 
+            # Similarities are only reused during the search, so release them before testing
+            self.cache_similarities = False
+            self._clear_similarity_cache()
             self._set_self(best_outer_config)
 
             if verbose:
@@ -118,14 +133,18 @@ class ItemKNNRecommender(BaseKNN):
             logger.info(f'Reusing params {self.optimal_params}')
             self._set_self(self.optimal_params)
 
+    def _clear_similarity_cache(self):
+        self.similarity_cache.clear()
+        self.similarity_cache_bytes = 0
+
     def _set_self(self, configuration):
+        # Cached similarities belong to a single metric
+        if configuration['metric'] != self.metric:
+            self._clear_similarity_cache()
+
         self.k = configuration['k']
-        if configuration['metric'] == 'cosine':
-            self.entity_vectors = self.plain_entity_vectors.copy()
-        elif configuration['metric'] == 'adjusted_cosine':
-            self.entity_vectors = self.user_adjusted_entity_vectors.copy()
-        elif configuration['metric'] == 'pearson':
-            self.entity_vectors = self.pearson_entity_vectors.copy()
+        self.metric = configuration['metric']
+        self._set_metric(configuration['metric'])
 
         if configuration['use_shrunk']:
             self.use_shrunk_similarity = True
@@ -134,14 +153,27 @@ class ItemKNNRecommender(BaseKNN):
             self.use_shrunk_similarity = False
 
     def _cosine_similarity(self, samples, ratings, eps=1e-8):
-        sample_vecs = self.entity_vectors[samples]
-        rating_vecs = self.entity_vectors[ratings]
-        top = np.einsum('ij,kj->ik', sample_vecs, rating_vecs)
-        samples_norm = np.sqrt(np.sum(sample_vecs ** 2, axis=1))
-        entity_norm = np.sqrt(np.sum(rating_vecs ** 2, axis=1))
-        bottom = np.maximum(np.einsum('i,k->ik', samples_norm, entity_norm), eps)
-
-        res = top / bottom
+        # The similarities only depend on the metric, so they are reused while searching k and the shrink factor
+        key, res = None, None
+        if self.cache_similarities:
+            key = (tuple(samples), tuple(ratings))
+            res = self.similarity_cache.get(key)
+
+        if res is None:
+            sample_vecs = self.entity_vectors[samples]
+            rating_vecs = self.entity_vectors[ratings]
+            top = np.einsum('ij,kj->ik', sample_vecs, rating_vecs)
+            samples_norm = np.sqrt(np.sum(sample_vecs ** 2, axis=1))
+            entity_norm = np.sqrt(np.sum(rating_vecs ** 2, axis=1))
+            bottom = np.maximum(np.einsum('i,k->ik', samples_norm, entity_norm), eps)
+
+            res = top / bottom
+
+            # Stop inserting once full rather than evicting, as the validation users are scanned in the same
+            # order on every pass and evicting would discard entries before they are reused
+            if self.cache_similarities and self.similarity_cache_bytes + res.nbytes <= self.similarity_cache_limit:
+                self.similarity_cache[key] = res
+                self.similarity_cache_bytes += res.nbytes
 
         if self.use_shrunk_similarity:
             ss_top = self.shrunk_similarity[samples][:, ratings]
@@ -159,12 +191,16 @@ class ItemKNNRecommender(BaseKNN):
         """
 
         rating_idx = [rating.e_idx for rating in self.user_ratings[user]]
-        ratings = [rating.rating for rating in self.user_ratings[user]]
+        ratings = np.array([rating.rating for rating in self.user_ratings[user]])
         cs = self._cosine_similarity(items, rating_idx)
-        score = {}
-        for index, similarities in enumerate(cs):
-            topk = sorted([(r, s) for r, s in zip(ratings, similarities)], key=lambda x: x[1], reverse=True)[:self.k]
-            score[items[index]] = np.einsum('i,i->', *zip(*topk))
+
+        # Only the k most similar rated entities contribute to an item's score
+        if self.k < len(ratings):
+            top_k = self._top_k(cs)
+            cs = np.take_along_axis(cs, top_k, axis=1)
+            ratings = ratings[top_k]
+
+        score = {item: s for item, s in zip(items, np.einsum('ij,ij->i', np.broadcast_to(ratings, cs.shape), cs))}
 
         # A high score means item knn is sure in a positive prediction.
         return score
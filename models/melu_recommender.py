@@ -54,7 +54,7 @@ class MeLURecommender(RecommenderBase):
         self.fast_weights = OrderedDict()
 
     def _get_indices(self):
-        df = pd.read_csv(self.split.experiment.dataset.triples_path)
+        df = pd.read_csv(self.split.experiment.dataset.triples_path, usecols=['head_uri', 'relation', 'tail_uri'])
         triples = [(h, r, t) for h, r, t in df[['head_uri', 'relation', 'tail_uri']].values]
         e_idx_map = self.split.experiment.dataset.e_idx_map
 
@@ -91,7 +91,7 @@ class MeLURecommender(RecommenderBase):
         return decade_index, movie_index, category_index, person_index, company_index
 
     def _create_metadata(self):
-        df = pd.read_csv(self.split.experiment.dataset.triples_path)
+        df = pd.read_csv(self.split.experiment.dataset.triples_path, usecols=['head_uri', 'relation', 'tail_uri'])
         triples = [(h, r, t) for h, r, t in df[['head_uri', 'relation', 'tail_uri']].values]
         e_idx_map = self.split.experiment.dataset.e_idx_map
 
@@ -3,8 +3,8 @@ from networkx import Graph
 
 
 class CollaborativePageRankRecommender(PageRankRecommender):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, use_cuda=False):
+        super().__init__(use_cuda)
 
     def construct_graph(self, training):
         return construct_collaborative_graph(Graph(), training)
@@ -3,8 +3,8 @@ from models.pagerank.pagerank_recommender import PageRankRecommender, construct_
 
 
 class JointPageRankRecommender(PageRankRecommender):
-    def __init__(self, split):
-        super().__init__()
+    def __init__(self, split, use_cuda=False):
+        super().__init__(use_cuda)
         self.triples_path = split.experiment.dataset.triples_path
         self.entity_idx = split.experiment.dataset.e_idx_map
 
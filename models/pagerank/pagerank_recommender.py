@@ -2,8 +2,11 @@ import operator
 from csv import DictReader
 from functools import reduce
 
+import numpy as np
+import torch as tt
+from joblib import Parallel, delayed
 from loguru import logger
-from networkx import pagerank_scipy, Graph
+from networkx import Graph, to_scipy_sparse_array
 
 from models.base_recommender import RecommenderBase
 from utility.utility import get_combinations
@@ -12,16 +15,14 @@ RATING_CATEGORIES = {1, 0, -1}
 
 
 def construct_collaborative_graph(graph, training, only_positive=False):
-    for user, ratings in training:
-        user_id = f'user_{user}'
-        graph.add_node(user_id, entity=False)
+    users = [f'user_{user}' for user, _ in training]
+    edges = [(f'user_{user}', rating.e_idx) for user, ratings in training for rating in ratings
+             if not (only_positive and rating.rating != 1)]
 
-        for rating in ratings:
-            if only_positive and rating.rating != 1:
-                continue
-
-            graph.add_node(rating.e_idx, entity=True)
-            graph.add_edge(user_id, rating.e_idx)
+    # Add nodes and edges in bulk, avoiding the per-call overhead of add_node and add_edge
+    graph.add_nodes_from(users, entity=False)
+    graph.add_nodes_from((entity for _, entity in edges), entity=True)
+    graph.add_edges_from(edges)
 
     return graph
 
@@ -31,6 +32,7 @@ def construct_knowledge_graph(triples_path, entity_idx):
 
     with open(triples_path, 'r') as graph_fp:
         graph_reader = DictReader(graph_fp)
+        edges = list()
 
         for row in graph_reader:
             head = row['head_uri']
@@ -38,22 +40,36 @@ def construct_knowledge_graph(triples_path, entity_idx):
 
             head = entity_idx[head] if head in entity_idx else head
             tail = entity_idx[tail] if tail in entity_idx else tail
-            relation = row['relation']
 
-            graph.add_node(head, entity=True)
-            graph.add_node(tail, entity=True)
-            graph.add_edge(head, tail, type=relation)
+            edges.append((head, tail, {'type': row['relation']}))
+
+    graph.add_nodes_from((node for head, tail, _ in edges for node in (head, tail)), entity=True)
+    graph.add_edges_from(edges)
 
     return graph
 
 
 class PageRankRecommender(RecommenderBase):
-    def __init__(self):
+    def __init__(self, use_cuda=False):
         super().__init__()
         self.graph = None
         self.user_ratings = dict()
         self.optimal_params = None
         self.entity_indices = set()
+        self.user_rating_categories = dict()
+        self.nodes = list()
+        self.node_index = dict()
+        self.entity_rows = None
+        self.graph_position = None
+        self.transition = None
+        self.dangling = None
+        self.max_iterations = 100
+        self.tolerance = 1e-6
+        self.batch_size = 256
+        self.n_jobs = -1
+        # Opt-in, as float32 sparse products on the GPU are not deterministic, which can change tie-broken rankings
+        self.device = tt.device('cuda:0') if use_cuda and tt.cuda.is_available() else None
+        self.device_transition = None
 
     def get_entity_indices(self):
         if self.entity_indices:
@@ -70,57 +86,210 @@ class PageRankRecommender(RecommenderBase):
         return indices
 
     def predict(self, user, items):
-        return self._scores(self.optimal_params['alpha'],
-                            self.get_node_weights(user, self.optimal_params['importance']), items)
+        personalization, _ = self._personalization([user], self.optimal_params['importance'])
+        scores = self._pagerank(self.optimal_params['alpha'], personalization)[:, 0]
+
+        # Emit items in graph node order, as NetworkX did, since callers break score ties by sorting stably
+        rows = sorted({self.node_index[item] for item in items if item in self.node_index},
+                      key=self.graph_position.__getitem__)
+
+        return {self.nodes[row]: scores[row] for row in rows}
 
     def construct_graph(self, training):
         raise NotImplementedError
 
-    def _scores(self, alpha, node_weights, items):
-        scores = pagerank_scipy(self.graph, alpha=alpha, personalization=node_weights).items()
+    def _prepare_csr(self):
+        # Order nodes by descending degree, placing the frequently visited nodes close together in the matrix
+        self.nodes = sorted(self.graph, key=self.graph.degree, reverse=True)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.entity_rows = np.array([self.node_index[idx] for idx in self.get_entity_indices()], dtype=np.int32)
+
+        # Position of every matrix row in the original graph node order, used to break score ties
+        self.graph_position = np.empty(len(self.nodes), dtype=np.int64)
+        for position, node in enumerate(self.graph):
+            self.graph_position[self.node_index[node]] = position
+
+        # Row-normalize the adjacency matrix into a transition matrix, built once and reused for every query
+        adjacency = to_scipy_sparse_array(self.graph, nodelist=self.nodes, dtype=np.float32, format='csr')
+        out_degree = np.asarray(adjacency.sum(axis=1), dtype=np.float32).flatten()
+        self.dangling = out_degree == 0
+
+        inverse_degree = np.zeros_like(out_degree)
+        inverse_degree[~self.dangling] = 1.0 / out_degree[~self.dangling]
+
+        # Stored transposed, such that a step for a (n_nodes, batch) matrix of rank vectors is one sparse product
+        self.transition = adjacency.multiply(inverse_degree[:, np.newaxis]).T.tocsr()
+
+        # Keep a copy of the transition matrix on the GPU when one is available
+        if self.device is not None:
+            transition = self.transition.tocoo()
+            indices = tt.from_numpy(np.vstack((transition.row, transition.col)).astype(np.int64))
+            values = tt.from_numpy(transition.data)
+            self.device_transition = tt.sparse_coo_tensor(indices, values, transition.shape).coalesce().to(self.device)
+
+    def _personalization(self, users, importance):
+        personalization = np.zeros((len(self.nodes), len(users)), dtype=np.float32)
+
+        for column, user in enumerate(users):
+            if not self.user_ratings[user]:
+                continue
+
+            rows, counts = self.get_rating_categories(user)
+
+            # Compute the weight of each rating category
+            rating_weight = {category: self._weight(category, counts, importance) for category in RATING_CATEGORIES}
+
+            # Assign weight to each node depending on their rating, unrated entities being unknown
+            personalization[self.entity_rows, column] = rating_weight[0]
+            for category in RATING_CATEGORIES:
+                personalization[rows[category], column] = rating_weight[category]
+
+        # NetworkX fails on an all-zero personalization. Fall back to a uniform one instead, such that every user
+        # can still be scored, and report which columns actually carry personalization.
+        mass = personalization.sum(axis=0)
+        personalized = mass > 0
+        personalization[:, ~personalized] = 1.0
+        mass[~personalized] = len(self.nodes)
+
+        return personalization / mass, personalized
+
+    def _pagerank(self, alpha, personalization):
+        """
+        Runs personalized PageRank for a batch of personalization vectors at once.
+        :param alpha: float - damping factor.
+        :param personalization: ndarray - (n_nodes, batch) matrix of column-normalized personalization vectors.
+        :return: ndarray - (n_nodes, batch) matrix of PageRank scores.
+        """
+        if self.device is not None:
+            return self._pagerank_device(alpha, personalization)
+
+        n_nodes = len(self.nodes)
+        ranks = np.full(personalization.shape, 1.0 / n_nodes, dtype=np.float32)
+
+        for _ in range(self.max_iterations):
+            previous = ranks
+
+            # Mass on dangling nodes is redistributed according to the personalization, as in NetworkX
+            dangling_mass = ranks[self.dangling].sum(axis=0)
+            ranks = alpha * (self.transition @ ranks + dangling_mass * personalization) + (1 - alpha) * personalization
+
+            if np.abs(ranks - previous).sum(axis=0).max() < n_nodes * self.tolerance:
+                break
+        else:
+            logger.warning(f'PageRank did not converge within {self.max_iterations} iterations')
 
-        return {item: score for item, score in scores if item in items}
+        return ranks
+
+    def _pagerank_device(self, alpha, personalization):
+        n_nodes = len(self.nodes)
+        personalization = tt.from_numpy(personalization).to(self.device)
+        dangling = tt.from_numpy(self.dangling).to(self.device)
+        ranks = tt.full(personalization.shape, 1.0 / n_nodes, dtype=tt.float32, device=self.device)
+
+        for _ in range(self.max_iterations):
+            previous = ranks
+
+            dangling_mass = ranks[dangling].sum(dim=0)
+            ranks = alpha * (tt.sparse.mm(self.device_transition, ranks) + dangling_mass * personalization) + \
+                (1 - alpha) * personalization
+
+            if (ranks - previous).abs().sum(dim=0).max().item() < n_nodes * self.tolerance:
+                break
+        else:
+            logger.warning(f'PageRank did not converge within {self.max_iterations} iterations')
+
+        return ranks.cpu().numpy()
 
     @staticmethod
-    def _weight(category, ratings, importance):
-        if not ratings[category] or not importance[category]:
+    def _weight(category, counts, importance):
+        if not counts[category] or not importance[category]:
             return 0
 
-        return importance[category] / len(ratings[category])
+        return importance[category] / counts[category]
 
-    def get_node_weights(self, user, importance):
-        if not self.user_ratings[user]:
-            return []
+    def get_rating_categories(self, user):
+        if user in self.user_rating_categories:
+            return self.user_rating_categories[user]
 
         ratings = {category: set() for category in RATING_CATEGORIES}
 
         for rating in self.user_ratings[user]:
             ratings[rating.rating].add(rating.e_idx)
 
-        # Find rated and unrated entities
+        # Find rated entities
         rated_entities = reduce(lambda a, b: a.union(b), ratings.values())
-        unrated_entities = self.get_entity_indices().difference(rated_entities)
+        entity_indices = self.get_entity_indices()
+
+        # Treat unrated entities as unknown ratings. Only their count is needed, so it is derived from the rated
+        # entities rather than materialising the unrated entities for every user.
+        counts = {category: len(ratings[category]) for category in RATING_CATEGORIES}
+        counts[0] += len(entity_indices) - len(entity_indices & rated_entities)
+
+        # Store the rated entities as matrix rows, such that personalization vectors are built by indexing
+        rows = {category: np.array([self.node_index[idx] for idx in ratings[category] if idx in self.node_index],
+                                   dtype=np.int32) for category in RATING_CATEGORIES}
+
+        self.user_rating_categories[user] = rows, counts
+
+        return rows, counts
+
+    def _validate(self, scores, validation_item, negatives, k=10):
+        if validation_item not in self.node_index:
+            return False
+
+        negatives = np.unique(np.array([self.node_index[item] for item in negatives
+                                        if item in self.node_index and item != validation_item], dtype=np.int64))
+
+        # Count the negatives ranked ahead of the validation item, ties being broken by graph node order
+        validation_row = self.node_index[validation_item]
+        validation_score = scores[validation_row]
+        negative_scores = scores[negatives]
+        ahead = (negative_scores > validation_score) | \
+            ((negative_scores == validation_score) &
+             (self.graph_position[negatives] < self.graph_position[validation_row]))
+        rank = np.count_nonzero(ahead)
 
-        # Treat unrated entities as unknown ratings
-        ratings[0] = ratings[0].union(unrated_entities)
+        return rank < k
 
-        # Compute the weight of each rating category
-        rating_weight = {category: self._weight(category, ratings, importance) for category in RATING_CATEGORIES}
+    def _evaluate(self, combination, validation):
+        logger.debug(f'Trying {combination}')
 
-        # Assign weight to each node depending on their rating
-        return {idx: rating_weight[category] for category in RATING_CATEGORIES for idx in ratings[category]}
+        hits = 0
+        count = 0
 
-    def _validate(self, alpha, source_nodes, validation_item, negatives, k=10):
-        scores = self._scores(alpha, source_nodes, [validation_item] + negatives)
-        scores = sorted(list(scores.items()), key=operator.itemgetter(1), reverse=True)[:k]
+        # Users without ratings cannot be personalized on
+        validation = [(user, validation_tuple) for user, validation_tuple in validation if self.user_ratings[user]]
 
-        return validation_item in [item[0] for item in scores]
+        for start in range(0, len(validation), self.batch_size):
+            users, batch = zip(*validation[start:start + self.batch_size])
+
+            # Solve PageRank for the whole batch of users at once
+            personalization, personalized = self._personalization(users, combination['importance'])
+            scores = self._pagerank(combination['alpha'], personalization)
+
+            for column, validation_tuple in enumerate(batch):
+                # Users with no weight under this combination would only be scored by global PageRank
+                if not personalized[column]:
+                    continue
+
+                hits += self._validate(scores[:, column], *validation_tuple)
+                count += 1
+
+        logger.debug(f'Hit: {hits / count * 100:.2f}%')
+
+        return combination, hits / count
 
     def fit(self, training, validation, max_iterations=100, verbose=True, save_to='./'):
         for user, ratings in training:
             self.user_ratings[user] = ratings
 
         self.graph = self.construct_graph(training)
+        self.max_iterations = max_iterations
+        self._prepare_csr()
+
+        # Categorize every user's ratings up front, as they are shared by all hyperparameter combinations
+        for user in self.user_ratings:
+            self.get_rating_categories(user)
 
         if not self.optimal_params:
             parameters = {
@@ -137,24 +306,9 @@ class PageRankRecommender(RecommenderBase):
             combinations = get_combinations(parameters)
             logger.debug(f'{len(combinations)} hyperparameter combinations')
 
-            results = list()
-
-            for combination in combinations:
-                logger.debug(f'Trying {combination}')
-
-                hits = 0
-                count = 0
-
-                for user, validation_tuple in validation:
-                    node_weights = self.get_node_weights(user, combination['importance'])
-                    if not node_weights:
-                        continue
-
-                    hits += self._validate(combination['alpha'], node_weights, *validation_tuple)
-                    count += 1
-
-                logger.debug(f'Hit: {hits / count * 100:.2f}%')
-                results.append((combination, hits / count))
+            # Combinations are independent and only read the shared graph, so evaluate them concurrently
+            results = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+                delayed(self._evaluate)(combination, validation) for combination in combinations)
 
             best = sorted(results, key=operator.itemgetter(1), reverse=True)[0][0]
             logger.info(f'Found best: {best}')
@@ -70,6 +70,10 @@ class SVDRecommender(RecommenderBase):
 
     def predict(self, user, items):
         scores = self._recommend(user)
-        item_scores = sorted(list(enumerate(scores)), key=operator.itemgetter(1), reverse=True)
 
-        return {index: score for index, score in item_scores if index in items}
+        # Only order the requested items, by descending score and then by index as before
+        candidates = np.unique(items)
+        candidates = candidates[candidates < len(scores)]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        return {index: scores[index] for index in candidates.tolist()}
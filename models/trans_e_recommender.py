@@ -98,7 +98,7 @@ def load_kg_triples(split):
     e_idx_map = split.experiment.dataset.e_idx_map
 
     with open(split.experiment.dataset.triples_path) as fp:
-        df = pd.read_csv(fp)
+        df = pd.read_csv(fp, usecols=['head_uri', 'relation', 'tail_uri'])
         triples = [(h, r, t) for h, r, t in df[['head_uri', 'relation', 'tail_uri']].values]
         triples = [(e_idx_map[h], r, e_idx_map[t]) for h, r, t in triples if h in e_idx_map and t in e_idx_map]
 
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.sparse import csc_matrix
 
 from data_loading.loo_data_loader import LeaveOneOutDataLoader
 from models.base_knn import BaseKNN
@@ -9,6 +10,8 @@ class UserKNNRecommender(BaseKNN):
     def __init__(self, split):
         super(UserKNNRecommender, self).__init__(split, split.n_users, split.n_entities)
         self.mean_centered_ratings = np.zeros((self.split.n_users, ))
+        self.metric_related_users = {}
+        self.related_users = None
 
         self.optimal_params = None
 
@@ -38,6 +41,11 @@ class UserKNNRecommender(BaseKNN):
             for user in indices:
                 self.pearson_entity_vectors[user][entity] = self.plain_entity_vectors[user][entity] - self.mean_centered_ratings[user]
 
+        self.metric_vectors = {'cosine': self.plain_entity_vectors, 'pearson': self.pearson_entity_vectors}
+
+        # Column-compressed copies give the users related to an item as a contiguous slice
+        self.metric_related_users = {metric: csc_matrix(vectors) for metric, vectors in self.metric_vectors.items()}
+
         if self.optimal_params is None:
             last_better = True
             best_outer_config = {'metric': 'cosine', 'k': 10, 'hit_rate': -1}
@@ -85,10 +93,13 @@ class UserKNNRecommender(BaseKNN):
 
     def _set_self(self, configuration):
         self.k = configuration['k']
-        if configuration['metric'] == 'cosine':
-            self.entity_vectors = self.plain_entity_vectors.copy()
-        elif configuration['metric'] == 'pearson':
-            self.entity_vectors = self.pearson_entity_vectors.copy()
+        self._set_metric(configuration['metric'])
+        self.related_users = self.metric_related_users[configuration['metric']]
+
+    def _get_related_users(self, item):
+        start, end = self.related_users.indptr[item], self.related_users.indptr[item + 1]
+
+        return self.related_users.indices[start:end]
 
     def predict(self, user, items):
         """
@@ -100,18 +111,29 @@ class UserKNNRecommender(BaseKNN):
 
         score = {}
 
+        related_users = {item: self._get_related_users(item) for item in items}
+
+        # Compute the similarity to every user related to any of the items in one batch
+        candidates = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + list(related_users.values())))
+        similarities = np.zeros(self.n_xs)
+        if candidates.size:
+            similarities[candidates] = self._cosine_similarity(user, candidates)
+
         for item in items:
-            related = np.where(self.entity_vectors[:, item] != 0)[0]
+            related = related_users[item]
 
             if related.size == 0:
                 score[item] = 0
                 continue
 
-            cs = self._cosine_similarity(user, related)
+            cs = similarities[related]
+
+            # Only the k most similar users contribute to the item's score
+            if self.k < related.size:
+                top_k = self._top_k(cs)
+                related, cs = related[top_k], cs[top_k]
 
-            top_k = sorted([(r, s) for r, s in zip(related, cs)], key=lambda x: x[1], reverse=True)[:self.k]
-            ratings = [(self.entity_vectors[i][item], sim) for i, sim in top_k]
-            score[item] = np.einsum('i,i->', *zip(*ratings))
+            score[item] = np.einsum('i,i->', self.entity_vectors[related, item], cs)
 
         # A high score means item knn is sure in a positive prediction.
         return score